@@ -1,6 +1,10 @@
+import asyncio
 import logging
+import sys
+import time
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Any, Iterable
+from io import BytesIO
+from typing import Optional, Dict, List, Any, Iterable, Callable, Awaitable, Union
 from xml.etree import ElementTree
 
 import httpx
@@ -12,6 +16,55 @@ from egauge_async.utils import create_query_string, QueryParam
 
 logger = logging.getLogger(__name__)
 
+# query parameter selecting the row interval of the egauge-show endpoint
+_INTERVAL_PARAMS: Dict[TimeInterval, str] = {
+    TimeInterval.SECOND: "S",
+    TimeInterval.MINUTE: "m",
+    TimeInterval.HOUR: "h",
+    TimeInterval.DAY: "d",
+}
+
+# the instantaneous query never changes, so only build it once
+_INSTANTANEOUS_QUERY = create_query_string(["inst", "tot"])
+
+
+class _RegisterCache(object):
+    """Register name -> type code mapping that expires after `ttl` seconds
+
+    Concurrent callers that find the cache empty or expired share a single fetch
+    rather than each querying the device.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._registers: Optional[Dict[str, str]] = None
+        self._fetched_at = 0.0
+        # created on first use so that it binds to the running event loop
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _get_fresh(self) -> Optional[Dict[str, str]]:
+        if time.monotonic() - self._fetched_at >= self.ttl:
+            return None
+        return self._registers
+
+    async def get(
+        self, fetch: Callable[[], Awaitable[Dict[str, str]]], force_refresh: bool
+    ) -> Dict[str, str]:
+        registers = None if force_refresh else self._get_fresh()
+        if registers is not None:
+            return registers
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # another task may have fetched the registers while we were waiting
+            registers = None if force_refresh else self._get_fresh()
+            if registers is None:
+                registers = await fetch()
+                self._registers = registers
+                self._fetched_at = time.monotonic()
+            return registers
+
 
 class EgaugeClient(object):
     """Provides `async` read access to an Egauge device using the [documented XML API]_
@@ -21,14 +74,32 @@ class EgaugeClient(object):
             and HTTPS are supported.
         username: Username for authentication if enabled on the Egauge
         password: Password for authentication if enabled on the Egauge
+        register_cache_ttl: Number of seconds for which the register lists returned
+            by `get_instantaneous_registers` and `get_historical_registers` are
+            cached before being fetched from the device again
+
+    The underlying HTTP connection pool is shared by all requests made through the
+    client. Use it as an async context manager (or call `close`) to release the
+    connections when done::
+
+        async with EgaugeClient("http://egauge12345.local") as egauge:
+            rates = await egauge.get_current_rates()
 
     .. [documented XML API] https://kb.egauge.net/books/egauge-meter-communication/page/xml-api
     """
 
     def __init__(
-        self, uri: str, username: Optional[str] = None, password: Optional[str] = None
+        self,
+        uri: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        register_cache_ttl: float = 3600,
     ):
         self.uri = uri
+        self._instantaneous_url = uri + "/cgi-bin/egauge" + _INSTANTANEOUS_QUERY
+        self._historical_url = uri + "/cgi-bin/egauge-show"
+        self._inst_registers = _RegisterCache(register_cache_ttl)
+        self._hist_registers = _RegisterCache(register_cache_ttl)
         auth: Optional[httpx.DigestAuth] = None
         if username is not None and password is not None:
             auth = httpx.DigestAuth(username=username, password=password)
@@ -40,6 +111,12 @@ class EgaugeClient(object):
         """Clean up the HTTP session"""
         await self.client.aclose()
 
+    async def __aenter__(self) -> "EgaugeClient":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
     async def get_instantaneous_data(self) -> DataRow:
         """Get a current snapshot of data on the eGauge.
 
@@ -49,17 +126,15 @@ class EgaugeClient(object):
         Returns:
             A single row of data
         """
-        url = self.uri + "/cgi-bin/egauge"
-        params: List[QueryParam] = ["inst", "tot"]
-        response = await self.client.get(url + create_query_string(params))
+        response = await self.client.get(self._instantaneous_url)
         if response.status_code != 200:
             raise EgaugeHTTPErrorCode(response.status_code)
-        return self._parse_instantaneous_data(response.text)
+        return self._parse_instantaneous_data(response.content)
 
     @staticmethod
-    def _parse_instantaneous_data(xml: str) -> DataRow:
+    def _parse_instantaneous_data(xml: Union[str, bytes]) -> DataRow:
         """Parse XML response from the instantaneous endpoint"""
-        logger.debug(f"Parsing instantaneous XML data:\n{xml}")
+        logger.debug("Parsing instantaneous XML data:\n%s", xml)
         root = ElementTree.fromstring(xml)
         ts_elem = root.find("ts")
         if ts_elem is None:
@@ -71,14 +146,16 @@ class EgaugeClient(object):
         register_data: Dict[str, RegisterData] = {}
         rows = root.findall("r")
         for r in rows:
+            # register names and type codes repeat on every poll, so intern them
+            # to share one string object per register across responses
             try:
-                name = r.attrib["n"]
+                name = sys.intern(r.attrib["n"])
             except KeyError:
                 raise EgaugeParsingException(
                     'Could not find attribute "n" for element "r"'
                 )
             try:
-                register_type = r.attrib["t"]
+                register_type = sys.intern(r.attrib["t"])
             except KeyError:
                 raise EgaugeParsingException(
                     'Could not find attribute "t" for element "r"'
@@ -138,22 +215,15 @@ class EgaugeClient(object):
         Returns:
             The requested data, ordered from newest to oldest
         """
-        url = self.uri + "/cgi-bin/egauge-show"
         params: List[QueryParam] = ["a"]
         if start is not None:
             params.append(("t", str(int(start.timestamp()))))
         if end is not None:
             params.append(("f", str(int(end.timestamp()))))
         if interval is not None:
-            if interval == TimeInterval.SECOND:
-                params.append("S")
-            elif interval == TimeInterval.MINUTE:
-                params.append("m")
-            elif interval == TimeInterval.HOUR:
-                params.append("h")
-            elif interval == TimeInterval.DAY:
-                params.append("d")
-            else:
+            try:
+                params.append(_INTERVAL_PARAMS[interval])
+            except KeyError:
                 raise ValueError(f"Unrecognized value {interval} for interval")
         if skip_rows is not None:
             params.append(("s", str(skip_rows)))
@@ -164,65 +234,93 @@ class EgaugeClient(object):
             params.append(("T", ts))
         if max_rows is not None:
             params.append(("n", str(max_rows)))
-        response = await self.client.get(url + create_query_string(params))
+        response = await self.client.get(
+            self._historical_url + create_query_string(params)
+        )
         if response.status_code != 200:
             raise EgaugeHTTPErrorCode(response.status_code)
-        return self._parse_historical_data(response.text)
+        return self._parse_historical_data(response.content)
 
     @staticmethod
-    def _parse_historical_data(xml: str) -> List[DataRow]:
-        """Parse the XML response returned by the stored data query"""
-        logger.debug(f"Parsing historical XML data: {xml}")
-        root = ElementTree.fromstring(xml)
+    def _parse_historical_data(xml: Union[str, bytes]) -> List[DataRow]:
+        """Parse the XML response returned by the stored data query
+
+        The document is parsed incrementally and each row element is discarded once
+        it has been converted, so memory use does not grow with the size of the
+        XML tree.
+        """
+        logger.debug("Parsing historical XML data: %s", xml)
+        if isinstance(xml, str):
+            xml = xml.encode()
         rows: List[DataRow] = []
         col_names: List[str] = []
         col_types: List[str] = []
-        for data_element in root.findall("data"):
-            try:
-                start_ts = datetime.fromtimestamp(
-                    int(data_element.attrib["time_stamp"], base=16)
-                )
-            except KeyError:
-                raise EgaugeParsingException(
-                    'Could not find element "time_stamp" for element "data"'
-                )
-            try:
-                delta = timedelta(seconds=int(data_element.attrib["time_delta"]))
-            except KeyError:
-                raise EgaugeParsingException(
-                    'Could not find element "time_delta" for element "data"'
-                )
-
-            if len(col_names) == 0:
-                for cname in data_element.findall("cname"):
-                    cname_str = cname.text
-                    if cname_str is None:
-                        raise EgaugeParsingException('"cname" element is empty')
-                    col_names.append(cname_str)
-                    try:
-                        register_type = cname.attrib["t"]
-                    except KeyError:
-                        raise EgaugeParsingException(
-                            'Could not find attribute "t" for element "cname"'
-                        )
-                    col_types.append(register_type)
-
-            if len(col_names) == 0:
-                raise EgaugeParsingException("Could not find column names in response")
-
-            for row_num, row in enumerate(data_element.findall("r")):
-                ts = start_ts - row_num * delta
+        # column names are only sent with the first data element
+        have_cnames = False
+        # registers of the rows in the current data element. Their timestamps are
+        # set once the end of the data element (and its attributes) is reached.
+        data_registers: List[Dict[str, RegisterData]] = []
+        for _, elem in ElementTree.iterparse(BytesIO(xml)):
+            tag = elem.tag
+            if tag == "r":
+                if len(col_names) == 0:
+                    raise EgaugeParsingException(
+                        "Could not find column names in response"
+                    )
                 registers = {}
-                for i, col in enumerate(row.findall("c")):
+                for i, col in enumerate(elem.findall("c")):
                     col_str = col.text
                     if col_str is None:
                         raise EgaugeParsingException('"c" element is empty')
                     registers[col_names[i]] = RegisterData(col_types[i], int(col_str))
-                rows.append(DataRow(timestamp=ts, registers=registers))
+                data_registers.append(registers)
+                elem.clear()
+            elif tag == "cname" and not have_cnames:
+                cname_str = elem.text
+                if cname_str is None:
+                    raise EgaugeParsingException('"cname" element is empty')
+                col_names.append(sys.intern(cname_str))
+                try:
+                    register_type = sys.intern(elem.attrib["t"])
+                except KeyError:
+                    raise EgaugeParsingException(
+                        'Could not find attribute "t" for element "cname"'
+                    )
+                col_types.append(register_type)
+            elif tag == "data":
+                try:
+                    start_ts = datetime.fromtimestamp(
+                        int(elem.attrib["time_stamp"], base=16)
+                    )
+                except KeyError:
+                    raise EgaugeParsingException(
+                        'Could not find element "time_stamp" for element "data"'
+                    )
+                try:
+                    delta = timedelta(seconds=int(elem.attrib["time_delta"]))
+                except KeyError:
+                    raise EgaugeParsingException(
+                        'Could not find element "time_delta" for element "data"'
+                    )
+                if len(col_names) == 0:
+                    raise EgaugeParsingException(
+                        "Could not find column names in response"
+                    )
+                have_cnames = True
+
+                # rows are ordered newest to oldest, one time_delta apart
+                ts = start_ts
+                for registers in data_registers:
+                    rows.append(DataRow(timestamp=ts, registers=registers))
+                    ts -= delta
+                data_registers = []
+                elem.clear()
 
         return rows
 
-    async def get_instantaneous_registers(self) -> Dict[str, str]:
+    async def get_instantaneous_registers(
+        self, force_refresh: bool = False
+    ) -> Dict[str, str]:
         """Get names and register type codes of instantaneous registers
 
         Register type codes are documented in the [XML API documentation]_
@@ -232,19 +330,28 @@ class EgaugeClient(object):
         "Total Usage" when queried through the instantaneous endpoint, but "use" when
         queried through the historical endpoint
 
+        The result is cached for `register_cache_ttl` seconds.
+
+        Args:
+            force_refresh: fetch the registers from the device even if a cached
+                result is available
+
         Returns:
             dictionary mapping register name to register type code
 
         .. [XML API documentation] https://kb.egauge.net/books/egauge-meter-communication/page/xml-api
         """
-        if not hasattr(self, "_inst_registers"):
-            data = await self.get_instantaneous_data()
-            self._inst_registers = {
-                k: v.register_type_code for k, v in data.registers.items()
-            }
-        return self._inst_registers
-
-    async def get_historical_registers(self) -> Dict[str, str]:
+        return await self._inst_registers.get(
+            self._fetch_instantaneous_registers, force_refresh
+        )
+
+    async def _fetch_instantaneous_registers(self) -> Dict[str, str]:
+        data = await self.get_instantaneous_data()
+        return {k: v.register_type_code for k, v in data.registers.items()}
+
+    async def get_historical_registers(
+        self, force_refresh: bool = False
+    ) -> Dict[str, str]:
         """Get names and register type codes of historical registers
 
         Register type codes are documented in the [XML API documentation]_
@@ -254,19 +361,24 @@ class EgaugeClient(object):
         "Total Usage" when queried through the instantaneous endpoint, but "use" when
         queried through the historical endpoint
 
+        The result is cached for `register_cache_ttl` seconds.
+
+        Args:
+            force_refresh: fetch the registers from the device even if a cached
+                result is available
+
         Returns:
             dictionary mapping register name to register type code
 
         .. [XML API documentation] https://kb.egauge.net/books/egauge-meter-communication/page/xml-api
         """
-        if not hasattr(self, "_hist_registers"):
-            data = await self.get_historical_data(
-                max_rows=1, interval=TimeInterval.SECOND
-            )
-            self._hist_registers = {
-                k: v.register_type_code for k, v in data[0].registers.items()
-            }
-        return self._hist_registers
+        return await self._hist_registers.get(
+            self._fetch_historical_registers, force_refresh
+        )
+
+    async def _fetch_historical_registers(self) -> Dict[str, str]:
+        data = await self.get_historical_data(max_rows=1, interval=TimeInterval.SECOND)
+        return {k: v.register_type_code for k, v in data[0].registers.items()}
 
     async def get_current_rates(self) -> Dict[str, float]:
         """Get current rates for all registers
@@ -319,13 +431,16 @@ class EgaugeClient(object):
         )
         data.sort(key=lambda d: d.timestamp)
         output = []
-        for i in range(len(data) - 1):
-            start = data[i].timestamp
-            end = data[i + 1].timestamp
-            start_vals = {k: r.value for k, r in data[i].registers.items()}
-            end_vals = {k: r.value for k, r in data[i + 1].registers.items()}
-            meas = {k: end_vals[k] - start_vals[k] for k in end_vals.keys()}
-            output.append({"start_ts": start, "end_ts": end, "measurements": meas})
+        for start, end in zip(data, data[1:]):
+            start_regs = start.registers
+            meas = {k: r.value - start_regs[k].value for k, r in end.registers.items()}
+            output.append(
+                {
+                    "start_ts": start.timestamp,
+                    "end_ts": end.timestamp,
+                    "measurements": meas,
+                }
+            )
         return output
 
     async def get_hourly_changes(self, num_hours: int):
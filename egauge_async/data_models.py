@@ -1,10 +1,17 @@
+import sys
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
-from typing import Dict, Optional
+from typing import Any, Dict, Optional
 
+# Slotted dataclasses are only supported on Python 3.10+. Their instances have no
+# __dict__, which makes the many rows created by historical queries smaller.
+_DATACLASS_OPTIONS: Dict[str, Any] = (
+    {"slots": True} if sys.version_info >= (3, 10) else {}
+)
 
-@dataclass
+
+@dataclass(**_DATACLASS_OPTIONS)
 class RegisterData(object):
     """Data from a single register
 
@@ -20,7 +27,7 @@ class RegisterData(object):
     rate: Optional[float] = None
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class DataRow(object):
     """A row of data from the Egauge
 
@@ -19,14 +19,14 @@ def create_query_string(params: Iterable[QueryParam]) -> str:
     Returns:
         The query string, including the leading "?"
     """
-    query_string = ""
+    parts = []
     for p in params:
-        sep = "?" if len(query_string) == 0 else "&"
-        query_string += sep
-        if isinstance(p, tuple) and len(p) == 2:
-            query_string += f"{p[0]}={p[1]}"
-        elif isinstance(p, str):
-            query_string += p
+        if isinstance(p, str):
+            parts.append(p)
+        elif isinstance(p, tuple) and len(p) == 2:
+            parts.append(f"{p[0]}={p[1]}")
         else:
             raise ValueError(f"Unsupported query parameter {p}")
-    return query_string
+    if len(parts) == 0:
+        return ""
+    return "?" + "&".join(parts)
@@ -1,30 +1,54 @@
 import asyncio
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Optional, Iterable
+from typing import Any, Optional, Iterable, Set
 from urllib.parse import urlparse
 
 import pytest
 
 from egauge_async.client import EgaugeClient
 from egauge_async.data_models import RegisterData, DataRow, TimeInterval
+from egauge_async.exceptions import EgaugeParsingException
 from egauge_async.utils import QueryParam
 
+INSTANTANEOUS_XML = """<?xml version="1.0" encoding="UTF-8" ?>
+    <data serial="0x7">
+    <ts>1603322016</ts>
+    <r t="P" n="Grid" did="0">
+        <v>3232317009</v>
+        <i>654</i>
+    </r>
+    <r t="P" n="solar" did="1">
+        <v>1010807136</v>
+        <i>-8</i>
+    </r>
+    <r t="P" n="solar+" did="2">
+        <v>818295664</v>
+        <i>0</i>
+    </r>
+    </data>
+"""
+
+INSTANTANEOUS_SINGLE_REGISTER_XML = """<?xml version="1.0" encoding="UTF-8" ?>
+    <data serial="0x7">
+    <ts>1603322016</ts>
+    <r t="P" n="Grid" did="0">
+        <v>3232317009</v>
+    </r>
+    </data>
+"""
 
-def assert_query_params(url: str, params: Iterable[QueryParam]) -> None:
-    expected_params = set(params)
 
-    test_params = set()
-    query_string = urlparse(url).query
-    param_chunks = query_string.split("&")
-    for chunk in param_chunks:
+def parse_query_params(query_string: str) -> Set[QueryParam]:
+    params: Set[QueryParam] = set()
+    for chunk in query_string.split("&"):
         if "=" in chunk:
             kv = chunk.split("=")
             assert len(kv) == 2, f"malformed query string chunk {chunk}"
-            test_params.add(tuple(kv))
+            params.add((kv[0], kv[1]))
         else:
-            test_params.add(chunk)
-    assert test_params == expected_params
+            params.add(chunk)
+    return params
 
 
 def mock_parser(xml_data):
@@ -36,6 +60,10 @@ class MockResponse:
     text: str
     status_code: int
 
+    @property
+    def content(self) -> bytes:
+        return self.text.encode()
+
 
 class MockAsyncClient(object):
     def __init__(
@@ -46,43 +74,38 @@ class MockAsyncClient(object):
         status_code: int = 200,
     ):
         self.parsed_url = urlparse(url)
-        self.params = params
+        self.params = None if params is None else set(params)
         self.response = MockResponse(response, status_code)
+        self.num_calls = 0
 
     async def get(self, url: str) -> MockResponse:
+        self.num_calls += 1
+        # yield to the event loop like a real request would
+        await asyncio.sleep(0)
         parsed = urlparse(url)
         assert parsed.scheme == self.parsed_url.scheme
         assert parsed.netloc == self.parsed_url.netloc
         assert parsed.path == self.parsed_url.path
         if self.params is not None:
-            assert_query_params(url, self.params)
+            assert parse_query_params(parsed.query) == self.params
         return self.response
 
 
+def make_client(
+    path: str,
+    params: Optional[Iterable[QueryParam]],
+    response: str,
+    **kwargs: Any,
+) -> EgaugeClient:
+    """Create a client for http://localhost that sends its requests to a mock"""
+    egauge = EgaugeClient("http://localhost", **kwargs)
+    egauge.client = MockAsyncClient("http://localhost" + path, params, response)
+    return egauge
+
+
 @pytest.mark.asyncio
 async def test_get_instantaneous_data():
-    xml_data = """<?xml version="1.0" encoding="UTF-8" ?>
-        <data serial="0x7">
-        <ts>1603322016</ts>
-        <r t="P" n="Grid" did="0">
-            <v>3232317009</v>
-            <i>654</i>
-        </r>
-        <r t="P" n="solar" did="1">
-            <v>1010807136</v>
-            <i>-8</i>
-        </r>
-        <r t="P" n="solar+" did="2">
-            <v>818295664</v>
-            <i>0</i>
-        </r>
-        </data>
-    """
-
-    egauge = EgaugeClient("http://localhost")
-    egauge.client = MockAsyncClient(
-        "http://localhost/cgi-bin/egauge", ["inst", "tot"], xml_data
-    )
+    egauge = make_client("/cgi-bin/egauge", ["inst", "tot"], INSTANTANEOUS_XML)
     result = await egauge.get_instantaneous_data()
 
     assert result.timestamp == datetime.fromtimestamp(1603322016)
@@ -97,10 +120,7 @@ async def test_get_instantaneous_data():
 async def test_historical_data_start():
     dt = datetime.fromtimestamp(1603322016)
 
-    egauge = EgaugeClient("http://localhost")
-    egauge.client = MockAsyncClient(
-        "http://localhost/cgi-bin/egauge-show", [("t", "1603322016"), "a"], ""
-    )
+    egauge = make_client("/cgi-bin/egauge-show", [("t", "1603322016"), "a"], "")
     egauge._parse_historical_data = mock_parser
     await egauge.get_historical_data(start=dt)
 
@@ -109,10 +129,7 @@ async def test_historical_data_start():
 async def test_historical_data_end():
     dt = datetime.fromtimestamp(1603322016)
 
-    egauge = EgaugeClient("http://localhost")
-    egauge.client = MockAsyncClient(
-        "http://localhost/cgi-bin/egauge-show", [("f", "1603322016"), "a"], ""
-    )
+    egauge = make_client("/cgi-bin/egauge-show", [("f", "1603322016"), "a"], "")
     egauge._parse_historical_data = mock_parser
     await egauge.get_historical_data(end=dt)
 
@@ -124,16 +141,29 @@ async def test_historical_data_specific():
         datetime.fromtimestamp(1603322216),
     ]
 
-    egauge = EgaugeClient("http://localhost")
-    egauge.client = MockAsyncClient(
-        "http://localhost/cgi-bin/egauge-show",
-        [("T", "1603322216,1603322016"), "a"],
-        "",
+    egauge = make_client(
+        "/cgi-bin/egauge-show", [("T", "1603322216,1603322016"), "a"], ""
     )
     egauge._parse_historical_data = mock_parser
     await egauge.get_historical_data(timestamps=dts)
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "interval,param",
+    [
+        (TimeInterval.SECOND, "S"),
+        (TimeInterval.MINUTE, "m"),
+        (TimeInterval.HOUR, "h"),
+        (TimeInterval.DAY, "d"),
+    ],
+)
+async def test_historical_data_interval(interval, param):
+    egauge = make_client("/cgi-bin/egauge-show", [param, "a"], "")
+    egauge._parse_historical_data = mock_parser
+    await egauge.get_historical_data(interval=interval)
+
+
 def test_parse_instantaneous_data():
     xml_data = """<?xml version="1.0" encoding="UTF-8" ?>
         <data serial="0x7">
@@ -161,24 +191,7 @@ def test_parse_instantaneous_data():
 
 
 def test_parse_instantaneous_data_with_rate():
-    xml_data = """<?xml version="1.0" encoding="UTF-8" ?>
-        <data serial="0x7">
-        <ts>1603322016</ts>
-        <r t="P" n="Grid" did="0">
-            <v>3232317009</v>
-            <i>654</i>
-        </r>
-        <r t="P" n="solar" did="1">
-            <v>1010807136</v>
-            <i>-8</i>
-        </r>
-        <r t="P" n="solar+" did="2">
-            <v>818295664</v>
-            <i>0</i>
-        </r>
-        </data>
-    """
-    parsed_data = EgaugeClient._parse_instantaneous_data(xml_data)
+    parsed_data = EgaugeClient._parse_instantaneous_data(INSTANTANEOUS_XML)
 
     assert parsed_data.timestamp == datetime.fromtimestamp(1603322016)
     assert parsed_data.registers == {
@@ -292,28 +305,23 @@ def test_parse_historical_data_multidata():
     ]
 
 
-@pytest.mark.asyncio
-async def test_get_instantaneous_registers():
+def test_parse_historical_data_missing_column_names():
     xml_data = """<?xml version="1.0" encoding="UTF-8" ?>
-        <data serial="0x7">
-        <ts>1603322016</ts>
-        <r t="P" n="Grid" did="0">
-            <v>3232317009</v>
-            <i>654</i>
-        </r>
-        <r t="P" n="solar" did="1">
-            <v>1010807136</v>
-            <i>-8</i>
-        </r>
-        <r t="P" n="solar+" did="2">
-            <v>818295664</v>
-            <i>0</i>
-        </r>
+        <group serial="0x7">
+        <data time_stamp="0x5f90cb80" time_delta="86400">
+            <r>
+            <c>3247728141</c>
+            </r>
         </data>
+        </group>
     """
+    with pytest.raises(EgaugeParsingException):
+        EgaugeClient._parse_historical_data(xml_data)
 
-    egauge = EgaugeClient("http://localhost")
-    egauge.client = MockAsyncClient("http://localhost/cgi-bin/egauge", None, xml_data)
+
+@pytest.mark.asyncio
+async def test_get_instantaneous_registers():
+    egauge = make_client("/cgi-bin/egauge", None, INSTANTANEOUS_XML)
     result = await egauge.get_instantaneous_registers()
 
     assert result == {
@@ -341,14 +349,47 @@ async def test_historical_data_registers():
         </group>
     """
 
-    egauge = EgaugeClient("http://localhost")
-    egauge.client = MockAsyncClient(
-        "http://localhost/cgi-bin/egauge-show", None, xml_data
-    )
+    egauge = make_client("/cgi-bin/egauge-show", None, xml_data)
     result = await egauge.get_historical_registers()
     assert result == {"Grid": "P", "solar": "P", "solar+": "P"}
 
 
+@pytest.mark.asyncio
+async def test_instantaneous_registers_cache_ttl(mocker):
+    mock_time = mocker.patch("egauge_async.client.time")
+    mock_time.monotonic.return_value = 1000.0
+    egauge = make_client(
+        "/cgi-bin/egauge",
+        None,
+        INSTANTANEOUS_SINGLE_REGISTER_XML,
+        register_cache_ttl=60,
+    )
+
+    assert await egauge.get_instantaneous_registers() == {"Grid": "P"}
+    mock_time.monotonic.return_value = 1059.0
+    assert await egauge.get_instantaneous_registers() == {"Grid": "P"}
+    assert egauge.client.num_calls == 1
+
+    mock_time.monotonic.return_value = 1060.0
+    assert await egauge.get_instantaneous_registers() == {"Grid": "P"}
+    assert egauge.client.num_calls == 2
+
+    assert await egauge.get_instantaneous_registers(force_refresh=True) == {"Grid": "P"}
+    assert egauge.client.num_calls == 3
+
+
+@pytest.mark.asyncio
+async def test_concurrent_registers_single_fetch():
+    egauge = make_client("/cgi-bin/egauge", None, INSTANTANEOUS_SINGLE_REGISTER_XML)
+
+    results = await asyncio.gather(
+        *[egauge.get_instantaneous_registers() for _ in range(50)]
+    )
+
+    assert all(r == {"Grid": "P"} for r in results)
+    assert egauge.client.num_calls == 1
+
+
 @pytest.mark.asyncio
 async def test_get_interval_changes(mocker):
     t1 = datetime.fromtimestamp(1000000000)
@@ -379,3 +420,20 @@ async def test_get_interval_changes(mocker):
         {"start_ts": t3, "end_ts": t2, "measurements": {"reg": 1}},
         {"start_ts": t2, "end_ts": t1, "measurements": {"reg": 2}},
     ]
+
+
+@pytest.mark.asyncio
+async def test_context_manager_closes_client():
+    egauge = EgaugeClient("http://localhost")
+    closed = []
+
+    async def mock_close():
+        closed.append(True)
+
+    egauge.close = mock_close
+
+    async with egauge as e:
+        assert e is egauge
+        assert closed == []
+
+    assert closed == [True]
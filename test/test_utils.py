@@ -9,8 +9,14 @@ from egauge_async.utils import create_query_string
         (["p"], "?p"),
         ([("k", "v")], "?k=v"),
         (["p", ("k", "v")], "?p&k=v"),
+        ([], ""),
     ]
 )
 def test_create_query_string(input, expected):
     qs = create_query_string(input)
     assert qs == expected
+
+
+def test_create_query_string_invalid():
+    with pytest.raises(ValueError):
+        create_query_string([("k", "v", "x")])